@@ -2,9 +2,18 @@
 # Copyright (c) 2024, University of Wisconsin-Madison and the author
 # MIT license
 
+import math
+import os
+import joblib
 import numpy
 import scipy.linalg
+import scipy.linalg.blas
+import scipy.linalg.lapack
 import sklearn.mixture
+try:
+    import numba
+except ImportError:
+    numba = None
 
 class AmusetTICA:
 
@@ -22,6 +31,16 @@ class AmusetTICA:
         True: Koopman matrix is symmetrized to ensure reversibility
         False: Koopman matrix is not symmetrized
 
+    use_float32 : bool, default: False
+        Use numpy.float32 for the input features and the outer product.
+        SVDs and the Koopman matrix are always computed in float64.
+        This is the default of use_float32 in fit(), build() and transform()
+
+    n_jobs : int, default: 1
+        Number of threads to build the outer products of different
+        trajectories in parallel. -1: use all CPUs. Threads run the numpy
+        code path of the Gaussian basis instead of the numba kernel
+
     Tutorial
     --------
       A standard protocol:
@@ -39,13 +58,17 @@ class AmusetTICA:
 
     """
 
-    def __init__(this, max_rank: int=0, reversible: bool=True):
+    def __init__(this, max_rank: int=0, reversible: bool=True, use_float32: bool=False, n_jobs: int=1):
         this.max_rank = max_rank
         this.reversible = reversible
+        this.use_float32 = use_float32
+        this.n_jobs = n_jobs
         this._basis_list = []
+        this._basis_soa = []
         this._tt_u = []
         this._tt_s = []
         this._tt_indices = []
+        this._tt_whitener = []
         this._tt_intra_svd_layers = 0
         this._traj_lens = []
         this._rank_used = 0
@@ -67,7 +90,7 @@ class AmusetTICA:
     def eigenvalues_(this):
         return this._ev_K
 
-    def save(this, file_name: str=""):
+    def save(this, file_name: str="", compress: bool=False):
         """
         Save the Amuset model to a dictionary or a file
 
@@ -77,6 +100,11 @@ class AmusetTICA:
             an NPZ file name to save the Amuset model
             will not save to file if file_name is empty
 
+        compress : bool, default: False
+            True: zlib-compress the NPZ file (slow, and float data hardly
+            compresses)
+            False: save an uncompressed NPZ file
+
         Return
         ------
         dic : dictionary
@@ -87,6 +115,7 @@ class AmusetTICA:
         dic = {}
         dic['max_rank']     = this.max_rank
         dic['reversible']   = this.reversible
+        dic['use_float32']  = this.use_float32
         dic['n_basis_list'] = len(this._basis_list)
         for i in range(len(this._basis_list)):
             dic['basis_list_'+str(i)] = this._basis_list[i]
@@ -103,7 +132,10 @@ class AmusetTICA:
         dic['timescales']   = this._timescales
 
         if len(file_name)>0:
-            numpy.savez_compressed(file_name, **dic)
+            if compress:
+                numpy.savez_compressed(file_name, **dic)
+            else:
+                numpy.savez(file_name, **dic)
 
         return dic
 
@@ -123,6 +155,9 @@ class AmusetTICA:
         """
 
         if isinstance(src, str):
+          # numpy.savez appends .npz to file names without it
+            if not os.path.exists(src) and os.path.exists(src+'.npz'):
+                src = src + '.npz'
             dic = numpy.load(src)
             dic = {key:dic[key] for key in dic.files}
         else:
@@ -133,9 +168,14 @@ class AmusetTICA:
             this.reversible = bool(dic['reversible'])
         else:
             this.reversible = True
+        if 'use_float32' in dic:
+            this.use_float32 = bool(dic['use_float32'])
+        else:
+            this.use_float32 = False
         this._basis_list = []
         for i in range(dic['n_basis_list']):
             this._basis_list.append(dic['basis_list_'+str(i)])
+        this._basis_soa = _basis_arrays(this._basis_list)
         this._tt_u = []
         this._tt_s = []
         this._tt_indices = []
@@ -143,6 +183,11 @@ class AmusetTICA:
             this._tt_u.append(dic['tt_u_'+str(i)])
             this._tt_s.append(dic['tt_s_'+str(i)])
             this._tt_indices.append(dic['tt_indices_'+str(i)])
+      # materialize the layers once, so that no call copies them again
+        this._tt_u = [numpy.ascontiguousarray(x) for x in this._tt_u]
+        this._tt_s = [numpy.ascontiguousarray(x) for x in this._tt_s]
+        this._tt_indices = [numpy.asarray(x, dtype=numpy.intp) for x in this._tt_indices]
+        this._tt_whitener = [_whitener(this._tt_u[i], this._tt_s[i]) for i in range(len(this._tt_u))]
         this._rank_used     = int(dic['rank'])
         this._K             = dic['K']
         this._ev_K          = dic['ev_K']
@@ -176,7 +221,7 @@ class AmusetTICA:
                 return True
         return False
 
-    def _build_outer_product(this, basis_list, data_matrix, build_model: bool, use_float32: bool=False):
+    def _build_outer_product(this, basis_list, data_blocks, build_model: bool, use_float32: bool=False):
         """
         Build the outer product of Amuset
     
@@ -185,8 +230,8 @@ class AmusetTICA:
         basis_list : 3D list, [[[mean,sigma], ...], ... ]
             list of Gaussian basis for each of the features
     
-        data_matrix : 2D array, [n_features, n_all_frames]
-            converted feature sequences
+        data_blocks : list of 2D arrays, [n_trajs][n_features, n_frames]
+            converted feature sequences, one block per trajectory
 
         build_model : bool
             True if building Amuset model, False if transforming Amuset model
@@ -196,71 +241,81 @@ class AmusetTICA:
     
         Returns
         -------
-        outer : 2D array, [n_features, n_all_frames]
-            the outer product of all basis
+        outer : list of 2D arrays, [n_trajs][n_basis, n_frames]
+            the outer product of all basis, one block per trajectory
     
         """
-      # convert data to Amuset compatible format
-        data_length = data_matrix.shape[1]
         i_intra_svd_layer = 0
 
+      # the Gaussian parameters of the model are converted once in build()/load()
+        if basis_list is this._basis_list:
+            basis_soa = this._basis_soa
+        else:
+            basis_soa = _basis_arrays(basis_list)
+
       # outer product
         if use_float32:
-            outer = [numpy.ones(data_length).astype(numpy.float32)]
+            dtype = numpy.float32
         else:
-            outer = [numpy.ones(data_length)]
+            dtype = numpy.float64
+        outer = [numpy.ones((1, block.shape[1]), dtype=dtype) for block in data_blocks]
+
+      # with intra-layer SVDs the input of each layer is a new whitened array,
+      # so one buffer per trajectory, sized for the largest layer, holds the
+      # outer products of all layers. Otherwise the input is the previous
+      # output, which grows every layer, and each layer allocates its output
+        bufs = [None] * len(data_blocks)
+        if this.max_rank>0:
+            n_rows = 1
+            buf_rows = 0
+            for il in range(len(basis_list)):
+                n_rows = min(n_rows, int(this.max_rank)) * (len(basis_soa[il][0]) + 1)
+                buf_rows = max(buf_rows, n_rows)
+            bufs = [numpy.empty(buf_rows*block.shape[1], dtype=dtype) for block in data_blocks]
+
         for il in range(len(basis_list)):
           # force to use tensor-train structure if max_rank is set
           # dimensionality reduction if number of basis overflows max_rank
+            whitener = None
             if this.max_rank>0:
                 if build_model:
-                    u, s, v = scipy.linalg.svd(outer, full_matrices=False, overwrite_a=True, check_finite=False)
-                    indices = numpy.argsort(s)[::-1]
-                    v = v[indices, :]
-                    outer = v
+                    u, s = _streamed_svd(outer)
+                  # only the top max_rank singular vectors are kept
+                    u = u[:, :int(this.max_rank)]
+                    s = s[:int(this.max_rank)]
+                  # singular values are already sorted in descending order
+                    indices = numpy.arange(len(s))
                     this._tt_u.append(u)
                     this._tt_s.append(s)
                     this._tt_indices.append(indices)
-                else:
-                    u = this._tt_u[i_intra_svd_layer]
-                    s = this._tt_s[i_intra_svd_layer]
-                    indices = this._tt_indices[i_intra_svd_layer]
-                    transform_v = numpy.matmul(numpy.matmul(numpy.diag(1.0/s), numpy.array(u).T), outer)
-                    transform_v = transform_v[indices, :]
-                    outer = transform_v
+                    this._tt_whitener.append(_whitener(u, s))
+                whitener = this._tt_whitener[i_intra_svd_layer]
+                indices = this._tt_indices[i_intra_svd_layer]
+                if not numpy.array_equal(indices, numpy.arange(len(indices))):
+                    whitener = whitener[indices, :]
+                if len(whitener)>this.max_rank:
+                    whitener = whitener[:int(this.max_rank)]
                 i_intra_svd_layer += 1
 
-            if this.max_rank>0 and len(outer)>this.max_rank:
-                outer = outer[:this.max_rank]
-
             if build_model:
                 this._tt_intra_svd_layers = i_intra_svd_layer
 
-          # outer product
-
-            if use_float32:
-                outer_a = numpy.array(outer).astype(numpy.float32)
-                outer_b = [numpy.ones(data_length).astype(numpy.float32)]
+          # outer product: Khatri-Rao product of outer_a [ra, T] and outer_b [rb, T]
+          # trajectories are independent within a layer
+            means, coef = basis_soa[il]
+            if this.n_jobs == 1:
+                for k in range(len(outer)):
+                    outer[k] = _expand_block(outer[k], whitener, data_blocks[k][il], means, coef, dtype, _kr_gauss, bufs[k])
             else:
-                outer_a = outer
-                outer_b = [numpy.ones(data_length)]
-    
-            for i in range(len(basis_list[il])):
-                mean  = basis_list[il][i][0]
-                sigma = basis_list[il][i][1]
-                if use_float32:
-                    outer_b.append(numpy.exp(-numpy.array(data_matrix[il]-mean)**2/2/sigma**2).astype(numpy.float32))
-                else:
-                    outer_b.append(numpy.exp(-numpy.array(data_matrix[il]-mean)**2/2/sigma**2))
-    
-            outer = []
-            for i in range(len(outer_a)):
-                for j in range(len(outer_b)):
-                    outer.append(outer_a[i] * outer_b[j])   
+              # numba's default threading layer can not be entered from several
+              # threads at once, numpy releases the GIL in the numpy kernel
+                outer = joblib.Parallel(n_jobs=this.n_jobs, backend='threading')(
+                    joblib.delayed(_expand_block)(outer[k], whitener, data_blocks[k][il], means, coef, dtype, _kr_gauss_numpy, bufs[k])
+                    for k in range(len(outer)))
 
         return outer
 
-    def build(this, basis_list, sequences, use_float32: bool=False):
+    def build(this, basis_list, sequences, use_float32: bool=None):
         """
         Build the tensor structure of Amuset
     
@@ -272,8 +327,9 @@ class AmusetTICA:
         sequences : 3D list, [n_trajs][n_frames, n_features]
             a list of feature sequences
     
-        use_float32 : bool, default: False
+        use_float32 : bool, default: None
             Use numpy.float32 in the outer product
+            None: use the use_float32 of the model
     
         Returns
         -------
@@ -285,31 +341,50 @@ class AmusetTICA:
     
         """
 
+        if use_float32 is None:
+            use_float32 = this.use_float32
+
         this._basis_list = basis_list
+        this._basis_soa = _basis_arrays(basis_list)
 
         this._tt_u = []
         this._tt_s = []
         this._tt_indices = []
+        this._tt_whitener = []
 
       # convert data to Amuset compatible format
-        data_matrix, traj_lens = _convert_sequences(sequences)
+        data_blocks, traj_lens = _convert_sequences_to_blocks(sequences, use_float32)
         this._traj_lens = traj_lens 
 
       # build the outer product
-        outer = this._build_outer_product(basis_list, data_matrix, True, use_float32)
-
-      # build the Amuset
-        u, s, cvs = scipy.linalg.svd(outer, full_matrices=False, overwrite_a=True, check_finite=False)
-        indices = numpy.argsort(s)[::-1]
-        cvs = cvs[indices, :]
+        outer = this._build_outer_product(basis_list, data_blocks, True, use_float32)
 
-        if this.max_rank>0 and len(cvs[0])>this.max_rank:
-            cvs = cvs[: this.max_rank]
+      # build the Amuset: the SVD is accumulated trajectory by trajectory, and
+      # only the kept right singular vectors are computed
+        u, s = _streamed_svd(outer)
+      # singular values are already sorted in descending order
+        indices = numpy.arange(len(s))
 
         this._tt_u.append(u)
         this._tt_s.append(s)
         this._tt_indices.append(indices)
+        this._tt_whitener.append(_whitener(u, s))
+
+        whitener = this._tt_whitener[-1]
+        if this.max_rank>0 and len(whitener)>this.max_rank:
+            whitener = whitener[: int(this.max_rank)]
+        cvs = numpy.empty((len(whitener), sum(traj_lens)), dtype=whitener.dtype)
+        pos = 0
+        for k in range(len(outer)):
+            numpy.matmul(whitener, outer[k], out=cvs[:, pos:pos+traj_lens[k]])
+            pos += traj_lens[k]
+          # release the outer product of this trajectory
+            outer[k] = None
+
         this._rank_used = len(cvs)
+        this._tt_u = [numpy.ascontiguousarray(x) for x in this._tt_u]
+        this._tt_s = [numpy.ascontiguousarray(x) for x in this._tt_s]
+        this._tt_indices = [numpy.asarray(x, dtype=numpy.intp) for x in this._tt_indices]
 
         return cvs, traj_lens
 
@@ -334,34 +409,67 @@ class AmusetTICA:
 
         """
 
-      # Loop over sequences to get indices arries
-        x_indices = numpy.array([], dtype=int)
-        y_indices = numpy.array([], dtype=int)
+      # Loop over sequences to get indices arries of the first/last lag_time
+      # frames of each trajectory
+        head_indices = []
+        tail_indices = []
         pos = 0
         for i in range(len(traj_lens)):
-            x_indices = numpy.concatenate((x_indices, numpy.arange(pos, pos + traj_lens[i] - lag_time)))
-            y_indices = numpy.concatenate((y_indices, numpy.arange(pos + lag_time, pos + traj_lens[i])))
+            n_edge = min(lag_time, traj_lens[i])
+            head_indices.extend(range(pos, pos + n_edge))
+            tail_indices.extend(range(pos + traj_lens[i] - n_edge, pos + traj_lens[i]))
             pos += traj_lens[i]
     
-      # compute the Koopman matrix
-        x_of_input = input_data[:, x_indices]
-        y_of_input = input_data[:, y_indices]
-        C00 = numpy.matmul(x_of_input, x_of_input.T)
-        C11 = numpy.matmul(y_of_input, y_of_input.T)
-        C01 = numpy.matmul(x_of_input, y_of_input.T)
+      # compute the Koopman matrix, always in float64
+        input_data = numpy.asarray(input_data, dtype=numpy.float64)
+      # C00 and C11 share all frames except the first/last lag_time frames
+      # of each trajectory: one syrk over all frames gives both of them
+        C_all = _gram(input_data)
+        head_of_input = input_data[:, head_indices]
+        tail_of_input = input_data[:, tail_indices]
+        C00 = C_all - numpy.matmul(tail_of_input, tail_of_input.T)
+        C11 = C_all - numpy.matmul(head_of_input, head_of_input.T)
+      # C01 from zero-copy views of each trajectory, which BLAS reads directly
+        C01 = numpy.zeros_like(C_all)
+        pos = 0
+        for i in range(len(traj_lens)):
+            if traj_lens[i] > lag_time:
+                x_of_input = input_data[:, pos : pos + traj_lens[i] - lag_time]
+                y_of_input = input_data[:, pos + lag_time : pos + traj_lens[i]]
+                C01 += numpy.matmul(x_of_input, y_of_input.T)
+            pos += traj_lens[i]
 
       # eigen decomposition or SVD of the Koopman matrix
         if this.reversible:
-            K = numpy.matmul(numpy.linalg.inv(C00+C11), C01+C01.T)
-            evK, vrK = numpy.linalg.eig(K)
+          # K = (C00+C11)^-1 (C01+C10) is the symmetric-definite generalized
+          # eigenproblem (C01+C10) v = ev (C00+C11) v: real, sorted output
+            C_sym = C01 + C01.T
+            C_sum = C00 + C11
+            try:
+              # C_sum = L L^T is factored once for K and the eigenproblem,
+              # which becomes L^-1 C_sym L^-T y = ev y with v = L^-T y
+                L, lower = scipy.linalg.cho_factor(C_sum, lower=True, check_finite=False)
+                K = scipy.linalg.cho_solve((L, lower), C_sym, check_finite=False)
+                A = scipy.linalg.solve_triangular(L, C_sym, lower=True, check_finite=False)
+                A = scipy.linalg.solve_triangular(L, A.T, lower=True, check_finite=False)
+                evK, vrK = scipy.linalg.eigh(A, check_finite=False)
+                vrK = scipy.linalg.solve_triangular(L, vrK, lower=True, trans='T', check_finite=False)
+                evK = evK[::-1]
+                vrK = vrK[:, ::-1]
+              # same normalization as numpy.linalg.eig: unit eigenvectors
+                vrK = vrK / numpy.linalg.norm(vrK, axis=0)
+            except numpy.linalg.LinAlgError:
+              # C_sum is not numerically positive-definite, fall back to LU
+                K = _solve_spd(C_sum, C_sym)
+                evK, vrK = numpy.linalg.eig(K)
+                idx = numpy.argsort(evK)[::-1]
+                evK = evK[idx]
+                vrK = vrK[:,idx]
         else:
-            K = numpy.matmul(numpy.linalg.inv(C00), C01)
+            K = _solve_spd(C00, C01)
+          # singular values are already sorted in descending order
             vlK, evK, vrK = scipy.linalg.svd(K, full_matrices=True, overwrite_a=False)
 
-        idx = numpy.argsort(evK)[::-1]
-        evK = evK[idx]
-        vrK = vrK[:,idx]
-
         this._K = K
         this._ev_K = evK
         this._vr_K = vrK
@@ -379,7 +487,7 @@ class AmusetTICA:
       # done 
         return this 
 
-    def fit(this, basis_list, sequences, lag_time: int, use_float32: bool=False) : 
+    def fit(this, basis_list, sequences, lag_time: int, use_float32: bool=None) : 
         """
         Build the tensor structure of Amuset
 
@@ -394,8 +502,9 @@ class AmusetTICA:
         lag_time : integer
             the lag time used to compute the time-lagged correlation matrix
 
-        use_float32 : bool, default: False
+        use_float32 : bool, default: None
             Use numpy.float32 in the outer product
+            None: use the use_float32 of the model
     
         Returns
         -------
@@ -454,7 +563,7 @@ class AmusetTICA:
     
         return cvs
 
-    def transform(this, sequences, cvs_list, use_right_vr: bool=True, use_float32: bool=False, _do_amuset_tica: bool=True) :
+    def transform(this, sequences, cvs_list, use_right_vr: bool=True, use_float32: bool=None, _do_amuset_tica: bool=True) :
         """
         Apply the Amuset model to the input_data
     
@@ -471,8 +580,9 @@ class AmusetTICA:
             True: use the right eigenvector of Koopman matrix
             False: use the left eigenvector of Koopman matrix
 
-        use_float32 : bool, default: False
+        use_float32 : bool, default: None
             Use numpy.float32 in the outer product
+            None: use the use_float32 of the model
 
         _do_amuset_tica : bool, default: True
             True: CVs are orthogonalized with eigenvectors of K
@@ -487,12 +597,18 @@ class AmusetTICA:
 
         basis_list = this._basis_list
 
-        data_matrix, traj_lens = _convert_sequences(sequences)
-        outer = this._build_outer_product(this._basis_list, data_matrix, False, use_float32)
-        transform_v = numpy.matmul(numpy.matmul(numpy.diag(1.0/this._tt_s[-1]), numpy.array(this._tt_u[-1]).T), outer)
-        transform_v = transform_v[this._tt_indices[-1], :]
-        if this.max_rank>0 and len(transform_v[0])>this.max_rank:
-            transform_v = transform_v[:this.max_rank]
+        if use_float32 is None:
+            use_float32 = this.use_float32
+
+        data_blocks, traj_lens = _convert_sequences_to_blocks(sequences, use_float32)
+        outer = this._build_outer_product(this._basis_list, data_blocks, False, use_float32)
+        whitener = this._tt_whitener[-1]
+        indices = this._tt_indices[-1]
+        if not numpy.array_equal(indices, numpy.arange(len(indices))):
+            whitener = whitener[indices, :]
+        if this.max_rank>0 and len(whitener)>this.max_rank:
+            whitener = whitener[:int(this.max_rank)]
+        transform_v = numpy.hstack([numpy.matmul(whitener, block) for block in outer])
 
         if isinstance(cvs_list, int):
             cvs_list = range(1, 1+cvs_list)
@@ -525,7 +641,7 @@ class Basis :
         return ret
 
     @staticmethod
-    def _find_by_GMM(sequences, n_basis_list, sigma: float=-1, random_seed: int=0):
+    def _find_by_GMM(sequences, n_basis_list, sigma: float=-1, random_seed: int=0, n_jobs: int=-1):
         """
         Find the basis list with Gaussian Mixture Model of scipy
 
@@ -545,6 +661,9 @@ class Basis :
         random_seed : int, default: 0
             the random seed of Gaussian mixture model
 
+        n_jobs : int, default: -1
+            number of processes to fit the features in parallel. -1: all CPUs
+
         Returns
         -------
         basis_list : 3D list, [[[mean,sigma], ...], ... ]
@@ -563,20 +682,10 @@ class Basis :
         mtics = data_matrix
         len_tics = traj_lens
 
-      # generate basis list
-        basis_list = []
-        for itic in range(len(n_basis_list)):
-            this_basis_list = []
-            gm = sklearn.mixture.GaussianMixture(n_components=n_basis_list[itic], random_state=random_seed)
-            gmf = gm.fit(mtics[itic].reshape([mtics[itic].shape[0],1]))
-            means = gmf.means_.reshape(n_basis_list[itic])
-            sigmas = gmf.covariances_.reshape(n_basis_list[itic])
-            for i in range(n_basis_list[itic]):
-                if sigma > 0:
-                    this_basis_list.append([means[i], sigma])
-                else:
-                    this_basis_list.append([means[i], sigmas[i]])
-            basis_list.append(this_basis_list)
+      # generate basis list: the features are fitted independently
+        basis_list = joblib.Parallel(n_jobs=n_jobs)(
+            joblib.delayed(_fit_one)(mtics[itic], n_basis_list[itic], sigma, random_seed)
+            for itic in range(len(n_basis_list)))
 
         return basis_list
 
@@ -606,7 +715,7 @@ class Basis :
         return ret
 
     @staticmethod
-    def find(sequences, n_basis_list, sigma: float, random_seed: int=0, mix: bool=True):
+    def find(sequences, n_basis_list, sigma: float, random_seed: int=0, mix: bool=True, n_jobs: int=-1):
         """
         Find the basis list with Gaussian Mixture Model
 
@@ -629,6 +738,9 @@ class Basis :
         mix : bool, default: True
             mix the basis obtained by the Gaussian Mixture Model
 
+        n_jobs : int, default: -1
+            number of processes to fit the features in parallel. -1: all CPUs
+
         Returns
         -------
         basis_list : 3D list, [[[mean,sigma], ...], ... ]
@@ -636,11 +748,11 @@ class Basis :
 
         """
         if mix:
-            basis_list_base = Basis._find_by_GMM(sequences, n_basis_list, sigma, random_seed)
+            basis_list_base = Basis._find_by_GMM(sequences, n_basis_list, sigma, random_seed, n_jobs)
             basis_list = Basis.mix(basis_list_base)
             return basis_list
         else:
-            basis_list = Basis._find_by_GMM(sequences, n_basis_list, sigma, random_seed)
+            basis_list = Basis._find_by_GMM(sequences, n_basis_list, sigma, random_seed, n_jobs)
             return basis_list
 
     @staticmethod
@@ -701,6 +813,350 @@ def _convert_sequences(sequences):
 
     return data_matrix, traj_lens
 
+def _fit_one(x, n_basis: int, sigma: float, random_seed: int):
+    """
+    Fit the Gaussian basis of one feature with Gaussian Mixture Model
+
+    Parameters
+    ----------
+    x : 1D array, [n_frames]
+        the feature sequence of all trajectories
+
+    n_basis : int
+        number of basis of this feature
+
+    sigma : float
+        predefined sigma instead of covariances of data
+        will use the covariances of Gaussian distribtuions if <= 0
+
+    random_seed : int
+        the random seed of Gaussian mixture model
+
+    Returns
+    -------
+    basis : 2D list, [[mean,sigma], ...]
+        Gaussian basis of this feature
+
+    """
+  # n_init, tol and max_iter are the sklearn defaults, pinned explicitly
+    gm = sklearn.mixture.GaussianMixture(n_components=n_basis, random_state=random_seed, n_init=1, tol=1e-3, max_iter=100)
+    gmf = gm.fit(x.reshape([x.shape[0],1]))
+    means = gmf.means_.reshape(n_basis)
+    sigmas = gmf.covariances_.reshape(n_basis)
+    basis = []
+    for i in range(n_basis):
+        if sigma > 0:
+            basis.append([means[i], sigma])
+        else:
+            basis.append([means[i], sigmas[i]])
+    return basis
+
+def _basis_arrays(basis_list):
+    """
+    Convert the basis list into arrays of the Gaussian parameters
+
+    Parameters
+    ----------
+    basis_list : 3D list, [[[mean,sigma], ...], ... ]
+        list of Gaussian basis for each of the features
+
+    Returns
+    -------
+    basis_soa : list of tuples, [n_features](means, coef)
+        1D arrays of the means and of -1/(2*sigma^2) of the Gaussian basis
+        of each feature, so the basis are exp((x-means)^2*coef)
+
+    """
+  # Basis.mix() shares one list object among all features: convert it once
+    converted = {}
+    basis_soa = []
+    for il in range(len(basis_list)):
+        key = id(basis_list[il])
+        if key not in converted:
+            n_basis = len(basis_list[il])
+            means = numpy.fromiter((b[0] for b in basis_list[il]), dtype=numpy.float64, count=n_basis)
+            sigmas = numpy.fromiter((b[1] for b in basis_list[il]), dtype=numpy.float64, count=n_basis)
+            converted[key] = (means, -0.5/(sigmas*sigmas))
+        basis_soa.append(converted[key])
+    return basis_soa
+
+def _kr_gauss_numpy(outer_a, x, means, coef, out):
+    """
+    Khatri-Rao product of outer_a and the Gaussian basis of one feature
+
+    Parameters
+    ----------
+    outer_a : 2D array, [n_a, n_frames]
+        the outer product of previous features
+
+    x : 1D array, [n_frames]
+        the feature sequence
+
+    means, coef : 1D array, [n_basis]
+        means and -1/(2*sigma^2) of the Gaussian basis of this feature
+
+    out : 2D array, [n_a*(n_basis+1), n_frames]
+        the output array. Row a*(n_basis+1) is outer_a[a], and row
+        a*(n_basis+1)+1+b is outer_a[a] times the b-th Gaussian basis
+
+    """
+    n_a, n_frames = outer_a.shape
+    outer_b = numpy.empty((len(means)+1, n_frames), dtype=out.dtype)
+    outer_b[0] = 1
+  # all Gaussian basis of this feature are evaluated with one exp() call
+    diff = x - means[:, None]
+    diff *= diff
+    diff *= coef[:, None]
+    numpy.exp(diff, out=outer_b[1:])
+    del diff
+    numpy.multiply(outer_a[:, None, :], outer_b[None, :, :], out=out.reshape(n_a, len(means)+1, n_frames))
+
+def _kr_gauss_loops(outer_a, x, means, coef, out):
+    """
+    Same as _kr_gauss_numpy, written as loops to be compiled by numba.
+    Gaussians are evaluated once per block of frames and multiplied into
+    out directly, without building the [n_basis+1, n_frames] outer_b.
+
+    """
+    n_a = outer_a.shape[0]
+    n_basis = means.shape[0]
+    n_frames = x.shape[0]
+    block = 1024
+    n_blocks = (n_frames + block - 1) // block
+    for ib in numba.prange(n_blocks):
+        t0 = ib * block
+        t1 = min(t0 + block, n_frames)
+        gauss = numpy.empty((n_basis, t1 - t0))
+        for b in range(n_basis):
+            for t in range(t0, t1):
+                z = x[t] - means[b]
+                gauss[b, t - t0] = math.exp(z * z * coef[b])
+        for a in range(n_a):
+            row = a * (n_basis + 1)
+            for t in range(t0, t1):
+                out[row, t] = outer_a[a, t]
+            for b in range(n_basis):
+                for t in range(t0, t1):
+                    out[row + 1 + b, t] = outer_a[a, t] * gauss[b, t - t0]
+
+if numba is not None:
+    _kr_gauss = numba.njit(parallel=True, fastmath=True, cache=True)(_kr_gauss_loops)
+else:
+    _kr_gauss = _kr_gauss_numpy
+
+def _expand_block(outer, whitener, x, means, coef, dtype, kr_gauss, buf=None):
+    """
+    Expand the outer product of one trajectory by one feature
+
+    Parameters
+    ----------
+    outer : 2D array, [n_a, n_frames]
+        the outer product of previous features of this trajectory
+
+    whitener : 2D array, [rank, n_a] or None
+        projection of the intra-SVD layer applied to outer first, see
+        _whitener(). None: no intra-SVD layer
+
+    x : 1D array, [n_frames]
+        the feature sequence of this trajectory
+
+    means, coef : 1D array, [n_basis]
+        the Gaussian basis of this feature, see _basis_arrays()
+
+    dtype : numpy.float32 or numpy.float64
+        dtype of the returned outer product
+
+    kr_gauss : function
+        _kr_gauss or _kr_gauss_numpy
+
+    buf : 1D array of dtype, default: None
+        buffer to hold the returned outer product, must not overlap the
+        input of kr_gauss. None: allocate a new array
+
+    Returns
+    -------
+    outer : 2D array, [n_a*(n_basis+1), n_frames] or [rank*(n_basis+1), n_frames]
+        the expanded outer product, a view of buf if given
+
+    """
+    if whitener is not None:
+        outer = numpy.matmul(whitener, outer)
+    outer_a = numpy.ascontiguousarray(outer, dtype=dtype)
+    del outer
+    n_rows = len(outer_a)*(len(means)+1)
+    if buf is None:
+        outer = numpy.empty((n_rows, outer_a.shape[1]), dtype=dtype)
+    else:
+        outer = buf[:n_rows*outer_a.shape[1]].reshape(n_rows, outer_a.shape[1])
+    kr_gauss(outer_a, x, means, coef, outer)
+    return outer
+
+def _streamed_svd(blocks):
+    """
+    Compute the thin SVD of numpy.hstack(blocks) without forming it
+
+    Parameters
+    ----------
+    blocks : list of 2D arrays, [n_blocks][n_rows, n_frames]
+        column blocks of the matrix, e.g. the outer product of each trajectory
+
+    Returns
+    -------
+    u : 2D array, [n_rows, rank]
+        the left singular vectors
+
+    s : 1D array, [rank]
+        the singular values, in descending order. Singular values below
+        s[0]*eps*max(n_rows, n_frames) are numerically zero and dropped
+        together with their singular vectors, see numpy.linalg.matrix_rank
+
+    """
+  # TSQR: hstack(blocks).T = Q @ R, so hstack(blocks) = R.T @ Q.T has the
+  # same left singular vectors and singular values as R.T. R is updated
+  # with a few blocks at a time. A Gram matrix hstack(blocks) @ hstack(blocks).T
+  # would be cheaper but squares the condition number of the outer product.
+  # R is always accumulated in float64, also for float32 blocks.
+    n_rows = blocks[0].shape[0]
+    r_t = numpy.zeros((n_rows, 0))
+  # LAPACK is called directly: the optimal workspace of geqrf only depends
+  # on the number of columns, so it is queried once for all blocks
+    geqrf, geqrf_lwork, gesdd, gesdd_lwork = scipy.linalg.lapack.get_lapack_funcs(('geqrf', 'geqrf_lwork', 'gesdd', 'gesdd_lwork'), (r_t,))
+    lwork = None
+    pending = []
+    n_pending = 0
+    for i in range(len(blocks)):
+        pending.append(blocks[i])
+        n_pending += blocks[i].shape[1]
+        if n_pending >= n_rows or i == len(blocks)-1:
+          # hstack gives a C-ordered array, whose transpose is Fortran-ordered
+            stacked = numpy.hstack([r_t] + pending)
+            if lwork is None:
+                work, info = geqrf_lwork(stacked.shape[1], n_rows)
+                lwork = max(int(work), n_rows, 1)
+            qr, tau, work, info = geqrf(stacked.T, lwork=lwork, overwrite_a=1)
+            if info != 0:
+                raise ValueError("illegal value in %d-th argument of internal geqrf" % -info)
+            r_t = numpy.triu(qr[:n_rows]).T
+            del stacked, qr
+            pending = []
+            n_pending = 0
+
+    m, n = r_t.shape
+    work, info = gesdd_lwork(m, n, compute_uv=1, full_matrices=0)
+    u, s, vt, info = gesdd(r_t, compute_uv=1, full_matrices=0, lwork=int(work), overwrite_a=1)
+    if info > 0:
+        raise numpy.linalg.LinAlgError("SVD did not converge")
+    if info < 0:
+        raise ValueError("illegal value in %d-th argument of internal gesdd" % -info)
+  # right singular vectors are recovered as diag(1/s) @ u.T @ blocks, which is
+  # meaningless for numerically zero singular values
+    n_frames = sum(block.shape[1] for block in blocks)
+    rank = numpy.count_nonzero(s > s[0]*numpy.finfo(s.dtype).eps*max(n_rows, n_frames))
+    return u[:, :rank], s[:rank]
+
+def _whitener(u, s):
+    """
+    Compute the matrix that projects an outer product onto its normalized
+    right singular vectors: diag(1/s) @ u.T
+
+    Parameters
+    ----------
+    u : 2D array, [n_basis, rank]
+        the left singular vectors
+
+    s : 1D array, [rank]
+        the singular values
+
+    Returns
+    -------
+    whitener : 2D array, [rank, n_basis]
+        C-ordered matrix so that whitener @ outer gives the singular vectors
+
+    """
+    return numpy.ascontiguousarray(u.T * (1.0/s)[:, None])
+
+def _gram(a):
+    """
+    Compute a @ a.T with a single BLAS syrk call
+
+    Parameters
+    ----------
+    a : 2D array, [n, m]
+        the input matrix
+
+    Returns
+    -------
+    c : 2D array, [n, n]
+        the symmetric matrix numpy.matmul(a, a.T)
+
+    """
+  # syrk only fills the upper triangle, and needs a Fortran-ordered input
+  # to avoid a copy. a.T of a C-ordered array is Fortran-ordered.
+    if a.flags.f_contiguous:
+        syrk, = scipy.linalg.blas.get_blas_funcs(('syrk',), (a,))
+        c = syrk(1.0, a, trans=0, lower=0)
+    elif a.flags.c_contiguous:
+        syrk, = scipy.linalg.blas.get_blas_funcs(('syrk',), (a,))
+        c = syrk(1.0, a.T, trans=1, lower=0)
+    else:
+        return numpy.matmul(a, a.T)
+    return c + numpy.triu(c, 1).T
+
+def _solve_spd(a, b):
+    """
+    Solve a x = b for a symmetric positive-definite matrix a
+
+    Parameters
+    ----------
+    a : 2D array, [n, n]
+        a symmetric positive-definite matrix, e.g. a covariance matrix
+
+    b : 2D array, [n, m]
+        the right-hand side
+
+    Returns
+    -------
+    x : 2D array, [n, m]
+        the solution, equivalent to numpy.matmul(numpy.linalg.inv(a), b)
+
+    """
+    try:
+        c_and_lower = scipy.linalg.cho_factor(a, lower=True, check_finite=False)
+        return scipy.linalg.cho_solve(c_and_lower, b, check_finite=False)
+    except numpy.linalg.LinAlgError:
+      # a is not numerically positive-definite, fall back to LU
+        lu_and_piv = scipy.linalg.lu_factor(a, check_finite=False)
+        return scipy.linalg.lu_solve(lu_and_piv, b, check_finite=False)
+
+def _convert_sequences_to_blocks(sequences, use_float32: bool=False):
+    """  
+    Convert sequences into a list of per-trajectory matrices
+
+    Parameters
+    ----------
+    sequences : 3D list, [n_trajs][n_frames, n_features]
+        a list of trajectories
+
+    use_float32 : bool, default: False
+        convert the sequences to numpy.float32
+
+    Returns
+    -------
+    data_blocks : list of 2D arrays, [n_trajs][n_features, n_frames]
+        the converted sequences
+
+    traj_lens : list, [n_trajs]
+        lengths of each trajectory
+
+    """
+    if use_float32:
+        dtype = numpy.float32
+    else:
+        dtype = numpy.float64
+    data_blocks = [numpy.ascontiguousarray(numpy.asarray(sequences[k]).T, dtype=dtype) for k in range(len(sequences))]
+    traj_lens = [len(sequences[k]) for k in range(len(sequences))]
+    return data_blocks, traj_lens
+
 def _convert_to_sequences(data, traj_lens):
     """  
     Convert matrix to sequences